@@ -1,5 +1,9 @@
+import multiprocessing
+import string
 import sys
 
+from collections import defaultdict, deque
+
 from crossword import *
 
 
@@ -10,19 +14,87 @@ class CrosswordCreator():
         Create new CSP crossword generate.
         """
         self.crossword = crossword
+
+        # Only words of a variable's length can ever fill it
+        words_by_length = defaultdict(set)
+        for word in self.crossword.words:
+            words_by_length[len(word)].add(word)
         self.domains = {
-            var: self.crossword.words.copy()
+            var: words_by_length[var.length].copy()
+            for var in self.crossword.variables
+        }
+        self.index_domains()
+        self._neighbors_cache = {
+            var: self.crossword.neighbors(var)
+            for var in self.crossword.variables
+        }
+        # Each variable's neighbors paired with their (never None) overlap,
+        # so hot loops need no `self.crossword.overlaps` lookups
+        self._neighbor_overlaps = {
+            var: [
+                (n, self.crossword.overlaps[var, n])
+                for n in self._neighbors_cache[var]
+            ]
             for var in self.crossword.variables
         }
+        self._compile_checks()
+
+        # Buffer reused by `letter_grid` on every call
+        self._grid = [
+            [None for _ in range(self.crossword.width)]
+            for _ in range(self.crossword.height)
+        ]
+
+        # Words used by the assignment `backtrack` is currently extending
+        self._used_words = set()
+
+        # Stack of frames recording the (variable, previous mask, removed
+        # words) of each domain narrowed since each decision `backtrack` made
+        self._trail = []
+
+    def __getstate__(self):
+        # Generated functions cannot be pickled; rebuild them on unpickling
+        state = self.__dict__.copy()
+        del state["_checks"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._compile_checks()
+
+    def _compile_checks(self):
+        """
+        Build `self._checks`, which maps each variable to a function
+        `check(word, assignment)` returning True if `word` agrees with the
+        words `assignment` gives that variable's neighbors. Each function is
+        generated with its neighbors' overlap indices written in as literals.
+        """
+        self._checks = dict()
+        for var in self.crossword.variables:
+            namespace = dict()
+            conditions = []
+            for k, (n, overlap) in enumerate(self._neighbor_overlaps[var]):
+                namespace[f"n{k}"] = n
+                conditions.append(
+                    f"(n{k} not in assignment"
+                    f" or word[{overlap[0]}] == assignment[n{k}][{overlap[1]}])"
+                )
+            source = (
+                "def check(word, assignment):\n"
+                "    return " + (" and ".join(conditions) or "True")
+            )
+            exec(source, namespace)
+            self._checks[var] = namespace["check"]
 
     def letter_grid(self, assignment):
         """
         Return 2D array representing a given assignment.
+        The array is reused (and overwritten) by the next call.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
+        letters = self._grid
+        blank = [None] * self.crossword.width
+        for row in letters:
+            row[:] = blank
         for variable, word in assignment.items():
             direction = variable.direction
             for k in range(len(word)):
@@ -64,6 +136,11 @@ class CrosswordCreator():
         font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
         draw = ImageDraw.Draw(img)
 
+        # Measure each letter once rather than once per cell
+        glyph_sizes = {
+            c: draw.textsize(c, font=font) for c in string.ascii_uppercase
+        }
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
@@ -76,7 +153,11 @@ class CrosswordCreator():
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
                     if letters[i][j]:
-                        w, h = draw.textsize(letters[i][j], font=font)
+                        if letters[i][j] not in glyph_sizes:
+                            glyph_sizes[letters[i][j]] = draw.textsize(
+                                letters[i][j], font=font
+                            )
+                        w, h = glyph_sizes[letters[i][j]]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
@@ -85,12 +166,16 @@ class CrosswordCreator():
 
         img.save(filename)
 
-    def solve(self):
+    def solve(self, workers=1):
         """
         Enforce node and arc consistency, and then solve the CSP.
+        If `workers` is greater than 1, search in that many processes.
         """
         self.enforce_node_consistency()
-        self.ac3()
+        if not self.ac3():
+            return None
+        if workers > 1:
+            return self.backtrack_parallel(workers)
         return self.backtrack(dict())
 
     def enforce_node_consistency(self):
@@ -100,12 +185,87 @@ class CrosswordCreator():
          constraints; in this case, the length of the word.)
         """
         for var in self.crossword.variables:
-            to_remove = []
+            self.domains[var] = {
+                word for word in self.domains[var] if len(word) == var.length
+            }
+
+    def index_domains(self):
+        """
+        Index the words in the domains so that each domain can be represented
+        as a bitmask over the words of its length.
+
+        `self.word_lists` maps each length to a list of words, and
+        `self.word_bits` maps each word to its bit in that list.
+        `self.letter_masks` maps each length, then each position, then each
+        letter to the mask of words with that letter at that position.
+        `self.masks` maps each variable to the mask of its domain.
+        """
+        self.word_lists = defaultdict(list)
+        self.word_bits = dict()
+        self.letter_masks = {
+            var.length: [dict() for _ in range(var.length)]
+            for var in self.crossword.variables
+        }
+        for word in set().union(*self.domains.values()):
+            self._index_word(word)
+
+        self.masks = dict()
+        self._sync_masks(self.crossword.variables)
+
+    def _index_word(self, word):
+        """
+        Give `word` the next bit for its length and add it to the letter masks.
+        """
+        words = self.word_lists[len(word)]
+        bit = 1 << len(words)
+        words.append(word)
+        self.word_bits[word] = bit
+        letter_masks = self.letter_masks.setdefault(
+            len(word), [dict() for _ in range(len(word))]
+        )
+        for pos, letter in enumerate(word):
+            letter_masks[pos][letter] = letter_masks[pos].get(letter, 0) | bit
+
+    def _sync_masks(self, variables):
+        """
+        Recompute the masks of `variables` from `self.domains`, so that
+        changes made directly to the domains are taken into account.
+        Words of the wrong length are left to `enforce_node_consistency`.
+        """
+        for var in variables:
+            mask = 0
             for word in self.domains[var]:
-                if not len(word) == var.length:
-                    to_remove.append(word)
-            for word in to_remove:
-                self.domains[var].remove(word)
+                if len(word) != var.length:
+                    continue
+                if word not in self.word_bits:
+                    self._index_word(word)
+                mask |= self.word_bits[word]
+            self.masks[var] = mask
+
+    def _narrow(self, var, mask):
+        """
+        Restrict the domain of `var` to the words in `mask`, which must be a
+        subset of its current domain, recording the change on the trail.
+        """
+        removed = self.masks[var] & ~mask
+        words = self.word_lists[var.length]
+        to_remove = []
+        while removed:
+            bit = removed & -removed
+            to_remove.append(words[bit.bit_length() - 1])
+            removed ^= bit
+        if self._trail:
+            self._trail[-1].append((var, self.masks[var], to_remove))
+        self.masks[var] = mask
+        self.domains[var].difference_update(to_remove)
+
+    def _restore(self, frame):
+        """
+        Undo the domain changes recorded in a trail `frame`.
+        """
+        for var, mask, removed in reversed(frame):
+            self.masks[var] = mask
+            self.domains[var].update(removed)
 
     def revise(self, x, y):
         """
@@ -121,23 +281,28 @@ class CrosswordCreator():
         overlap = self.crossword.overlaps[x, y]
         if overlap is None:
             return False
+        self._sync_masks((x, y))
+        return self._revise(x, y, overlap)
 
-        revision = False
-        to_remove = []
-        for word in self.domains[x]:
-            c1 = word[overlap[0]]
-            overlapping = False
-            for w in self.domains[y]:
-                if w[overlap[1]] == c1:
-                    overlapping = True
-            if not overlapping:
-                revision = True
-                to_remove.append(word)
-
-        for word in to_remove:
-            self.domains[x].remove(word)
+    def _revise(self, x, y, overlap):
+        """
+        Like `revise`, given the (non-None) `overlap` of `x` and `y`, and
+        trusting `self.masks` to match the domains.
+        """
+        # Keep the words of `x` whose letter at the overlap is also the
+        # letter of some word in `y`'s domain
+        x_mask = self.masks[x]
+        y_mask = self.masks[y]
+        y_letters = self.letter_masks[y.length][overlap[1]]
+        supported = 0
+        for letter, mask in self.letter_masks[x.length][overlap[0]].items():
+            if x_mask & mask and y_mask & y_letters.get(letter, 0):
+                supported |= mask
+        if x_mask & supported == x_mask:
+            return False
 
-        return revision
+        self._narrow(x, x_mask & supported)
+        return True
 
     def ac3(self, arcs=None):
         """
@@ -148,21 +313,52 @@ class CrosswordCreator():
         Return True if arc consistency is enforced and no domains are empty;
         return False if one or more domains end up empty.
         """
+        self._sync_masks(self.crossword.variables)
+        return self._ac3(arcs, dict())
+
+    def _ac3(self, arcs, assignment):
+        """
+        Like `ac3`, trusting `self.masks` to match the domains. Arcs into
+        variables in `assignment` are not revisited.
+        """
         if arcs is None:
-            arcs = []
-            for var in self.crossword.variables:
-                for neighbor in self.crossword.neighbors(var):
-                    if (neighbor, var) not in arcs:
-                        arcs.append((var, neighbor))
-
-        while len(arcs) > 0:
-            x, y = arcs.pop(0)
-            if self.revise(x, y):
-                if self.domains[x] == 0:
+            # Both directions of every edge, as each arc only revises its
+            # first variable
+            arcs = [
+                (var, neighbor)
+                for var in self.crossword.variables
+                for neighbor in self._neighbors_cache[var]
+            ]
+
+        # Queue each arc at most once, together with its overlap so that
+        # `_revise` need not look it up; `pending` mirrors the queue's arcs
+        queue = deque()
+        pending = set()
+        for x, y in arcs:
+            overlap = self.crossword.overlaps.get((x, y))
+            if overlap is not None and (x, y) not in pending:
+                pending.add((x, y))
+                queue.append((x, y, overlap))
+
+        # Bind the hot lookups once rather than per arc
+        neighbor_overlaps = self._neighbor_overlaps
+        domains = self.domains
+        revise = self._revise
+        popleft, append = queue.popleft, queue.append
+
+        while queue:
+            x, y, overlap = popleft()
+            pending.remove((x, y))
+            if revise(x, y, overlap):
+                if not domains[x]:
                     return False
-                for neighbor in self.crossword.neighbors(var):
-                    if neighbor != y and (x, neighbor)not in arcs:
-                        arcs.append((x, neighbor))
+                for neighbor, (i, j) in neighbor_overlaps[x]:
+                    if neighbor == y or neighbor in assignment:
+                        continue
+                    arc = (neighbor, x)
+                    if arc not in pending:
+                        pending.add(arc)
+                        append((neighbor, x, (j, i)))
         return True
 
     def assignment_complete(self, assignment):
@@ -170,31 +366,35 @@ class CrosswordCreator():
         Return True if `assignment` is complete (i.e., assigns a value to each
         crossword variable); return False otherwise.
         """
-        for var in self.crossword.variables:
-            if var not in assignment.keys():
-                return False
-        return True
+        return len(assignment) == len(self.crossword.variables)
 
     def consistent(self, assignment):
         """
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        words = []
+        words = set()
         for var in assignment:
             if not var.length == len(assignment[var]):
                 return False
             if assignment[var] not in words:
-                words.append(assignment[var])
+                words.add(assignment[var])
             else:
                 return False
-            for n in self.crossword.neighbors(var):
-                if n in assignment:
-                    if not assignment[var][self.crossword.overlaps[var, n][0]] == assignment[n][self.crossword.overlaps[var, n][1]]:
-                        return False
+            if not self._checks[var](assignment[var], assignment):
+                return False
 
         return True
 
+    def _consistent_for(self, var, word, assignment):
+        """
+        Return True if assigning `word` to `var` keeps an already consistent
+        `assignment` consistent; only `var`'s own constraints are checked.
+        """
+        if word in self._used_words:
+            return False
+        return self._checks[var](word, assignment)
+
     def order_domain_values(self, var, assignment):
         """
         Return a list of values in the domain of `var`, in order by
@@ -202,24 +402,35 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        result = []
-        for word in self.domains[var]:
-            count = 0
-            for n in self.crossword.neighbors(var):
-                if n not in assignment:
-                    overlap = self.crossword.overlaps[var, n]
-                    for n_word in self.domains[n]:
-                        if not word[overlap[0]] == n_word[overlap[1]]:
-                            count += 1
-            result.append((word, count))
-        result.sort(key=self.count)
-        word_result = []
-        for word, count in result:
-            word_result.append(word)
-        return word_result
-
-    def count(self, pair):
-        return pair[1]
+        self._sync_masks([var] + [
+            n for n in self._neighbors_cache[var] if n not in assignment
+        ])
+        return self._order_domain_values(var, assignment)
+
+    def _order_domain_values(self, var, assignment):
+        """
+        Like `order_domain_values`, trusting `self.masks` to match the domains.
+        """
+        # For each unassigned neighbor, a word with letter `c` at the overlap
+        # rules out every neighbor value without `c` at its side of it
+        neighbors = []
+        for n, overlap in self._neighbor_overlaps[var]:
+            if n not in assignment:
+                n_mask = self.masks[n]
+                matching = {
+                    letter: bin(n_mask & mask).count("1")
+                    for letter, mask in
+                    self.letter_masks[n.length][overlap[1]].items()
+                }
+                neighbors.append((overlap[0], matching, len(self.domains[n])))
+
+        def ruled_out(word):
+            return sum(
+                size - matching.get(word[pos], 0)
+                for pos, matching, size in neighbors
+            )
+
+        return sorted(self.domains[var], key=ruled_out)
 
     def select_unassigned_variable(self, assignment):
         """
@@ -229,25 +440,12 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        min_domain_vars = []
-        min = 1000000
-        for var in self.crossword.variables:
-            if var not in assignment:
-                if len(self.domains[var]) < min:
-                    min = len(self.domains[var])
-                    min_domain_vars.clear()
-                    min_domain_vars.append(var)
-                elif len(self.domains[var]) == min:
-                    min_domain_vars.append(var)
-        if len(min_domain_vars) == 1:
-            return min_domain_vars[0]
-        min_n = 1000000
-        min_var = None
-        for var in min_domain_vars:
-            if len(self.crossword.neighbors(var)) < min_n:
-                min_n = len(self.crossword.neighbors(var))
-                min_var = var
-        return min_var
+        unassigned = [
+            var for var in self.crossword.variables if var not in assignment
+        ]
+        return min(unassigned, key=lambda var: (
+            len(self.domains[var]), -len(self._neighbors_cache[var])
+        ))
 
     def backtrack(self, assignment):
         """
@@ -255,23 +453,132 @@ class CrosswordCreator():
         crossword and return a complete assignment if possible to do so.
 
         `assignment` is a mapping from variables (keys) to words (values).
+        It is left unchanged; the complete assignment is returned as a copy.
 
         If no assignment is possible, return None.
         """
+        self._sync_masks(self.crossword.variables)
+        self._used_words = set(assignment.values())
+        return self._backtrack(assignment)
+
+    def _backtrack(self, assignment):
+        """
+        Like `backtrack`, trusting `self.masks` to match the domains and
+        `self._used_words` to hold the words in `assignment`.
+        """
+        if self.assignment_complete(assignment):
+            return dict(assignment)
+
+        # Search iteratively: each stack frame holds a variable and the
+        # values still to try for it; a frame's variable is in `assignment`
+        # exactly while one of its values is being explored
+        var = self.select_unassigned_variable(assignment)
+        stack = [(var, iter(self._order_domain_values(var, assignment)))]
+        while stack:
+            var, values = stack[-1]
+            if var in assignment:
+                self._unassign(var, assignment)
+            for value in values:
+                if self._assign(var, value, assignment):
+                    break
+            else:
+                stack.pop()
+                continue
+            if self.assignment_complete(assignment):
+                solution = dict(assignment)
+
+                # Unwind so the domains are left as they were on entry
+                for var, _ in reversed(stack):
+                    self._unassign(var, assignment)
+                return solution
+            var = self.select_unassigned_variable(assignment)
+            values = iter(self._order_domain_values(var, assignment))
+            stack.append((var, values))
+        return None
+
+    def backtrack_parallel(self, workers):
+        """
+        Like `backtrack` from an empty assignment, but partition the search
+        by the value of the first variable chosen, and explore the resulting
+        subtrees in a pool of `workers` processes.
+
+        Return the first complete assignment any worker finds, or None.
+        """
+        self._sync_masks(self.crossword.variables)
+        self._used_words = set()
+        assignment = dict()
         if self.assignment_complete(assignment):
             return assignment
         var = self.select_unassigned_variable(assignment)
-        for value in self.order_domain_values(var, assignment):
-            assignment[var] = value
-            if self.consistent(assignment):
-                result = self.backtrack(assignment)
+        tasks = [
+            (var, value)
+            for value in self._order_domain_values(var, assignment)
+        ]
+
+        # Leaving the block terminates the workers still searching
+        with multiprocessing.Pool(workers, _init_worker, (self,)) as pool:
+            for result in pool.imap_unordered(_search_subtree, tasks):
                 if result is not None:
                     return result
-                del assignment[var]
-            else:
-                del assignment[var]
         return None
 
+    def _assign(self, var, value, assignment):
+        """
+        Assign `value` to `var` if that is consistent with `assignment`, and
+        maintain arc consistency with `var`'s unassigned neighbors.
+
+        Return True if the assignment was made; otherwise leave `assignment`
+        and the domains unchanged and return False.
+        """
+        if not self._consistent_for(var, value, assignment):
+            return False
+        assignment[var] = value
+        self._used_words.add(value)
+
+        self._trail.append([])
+        self._narrow(var, self.word_bits[value])
+        arcs = deque(
+            (n, var) for n in self._neighbors_cache[var]
+            if n not in assignment
+        )
+        if self._ac3(arcs, assignment):
+            return True
+        self._unassign(var, assignment)
+        return False
+
+    def _unassign(self, var, assignment):
+        """
+        Undo `_assign` for `var`, restoring the domains it pruned.
+        """
+        self._restore(self._trail.pop())
+        self._used_words.discard(assignment.pop(var))
+
+
+# The creator each worker process of `backtrack_parallel` searches with
+_worker_creator = None
+
+
+def _init_worker(creator):
+    global _worker_creator
+    _worker_creator = creator
+
+
+def _search_subtree(task):
+    """
+    Search the subtree in which `var` is assigned `value`, for a task
+    `(var, value)`. Return a complete assignment, or None if there is none.
+    """
+    var, value = task
+    creator = _worker_creator
+    assignment = dict()
+    if not creator._assign(var, value, assignment):
+        return None
+    solution = creator._backtrack(assignment)
+
+    # Unwind so the worker's domains are intact for its next task
+    creator._unassign(var, assignment)
+    return solution
+
 
 def main():
 